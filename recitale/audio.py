@@ -1,10 +1,11 @@
 import logging
+import threading
 
 from json import dumps as json_dumps
 from pathlib import Path
 from zlib import crc32
 
-from .utils import remove_superficial_options
+from .utils import remove_superficial_options, source_path
 
 
 logger = logging.getLogger("recitale." + __name__)
@@ -36,18 +37,24 @@ class BaseAudio:
 
     def reencode(self):
         reencode = Reencode(self.filepath, self.chksum_opt, self.options["extension"])
-        return self.reencodes.setdefault(reencode.filepath, reencode).filepath.name
+        # See ImageFactory.lock
+        with AudioFactory.lock:
+            reencode = self.reencodes.setdefault(reencode.filepath, reencode)
+        return reencode.filepath.name
 
 
 # TODO: add support for looking into parent directories (name: ../other_gallery/pic.jpg)
 class AudioFactory:
     base_audios = dict()
     global_options = dict()
+    # See ImageFactory.lock
+    lock = threading.Lock()
 
     @classmethod
     def get(cls, path, filepath):
-        # To resolve paths with .. in them, we need to resolve the path first and then
-        # find the relative path to the source (current) directory.
-        filepath = Path(path).joinpath(filepath).resolve().relative_to(Path.cwd())
+        filepath = source_path(path, filepath)
         baud = BaseAudio(filepath, cls.global_options)
-        return cls.base_audios.setdefault(baud.filepath / str(baud.chksum_opt), baud)
+        with cls.lock:
+            return cls.base_audios.setdefault(
+                baud.filepath / str(baud.chksum_opt), baud
+            )
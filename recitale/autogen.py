@@ -77,7 +77,7 @@ def build_template(folder, force):
         cover=gallery_settings["cover"],
         files=sorted(files_grabbed, key=get_exif),
     )
-    settings = open(Path(".").joinpath(folder, "settings.yaml").abspath(), "w")
+    settings = open(os.path.join(folder, "settings.yaml"), "w")
     settings.write(msg)
     logger.info("Generation: %s gallery", folder)
 
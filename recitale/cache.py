@@ -1,9 +1,6 @@
 import json
 import logging
 import os
-import signal
-
-from multiprocessing import Manager
 
 from .utils import remove_superficial_options
 
@@ -31,15 +28,43 @@ class Cache:
             print("info: cache format as changed, prune cache")
             cache = {"version": CACHE_VERSION}
 
-        # Make the Manager server process ignore the SIGINT (Ctrl+, aka KeyboardInterrupt exception)
-        # so that it is possible to still dump the cache variable after a KeyboardInterrupt.
-        old = signal.signal(signal.SIGINT, signal.SIG_IGN)
-        self.cache = Manager().dict(cache)
-        # Current process should handle SIGINT as it used to do before starting the Manager process.
-        signal.signal(signal.SIGINT, old)
+        # Thumbnails and reencodes are generated from threads of the main process, so a plain
+        # dict can be shared with them. This avoids a round-trip to a Manager server process for
+        # each cache lookup.
+        self.cache = cache
+
+        # Content of directories listed by prewarm(), as a set of filenames per directory
+        self.listing = {}
+        # Sources won't change during a build, so their size only needs to be read once
+        self.sizes = {}
+
+    def prewarm(self, paths):
+        # Checking the existence of thousands of targets one by one is costly, especially on slow
+        # or network filesystems. Instead, list once the content of each directory containing at
+        # least one of the targets.
+        for directory in {os.path.dirname(path) for path in paths}:
+            try:
+                with os.scandir(directory or ".") as entries:
+                    self.listing[directory] = {
+                        entry.name for entry in entries if entry.is_file()
+                    }
+            except OSError:
+                # Directory doesn't exist (yet), or can't be listed: fallback to os.path.exists.
+                continue
+
+    def exists(self, path):
+        directory, name = os.path.split(path)
+        if directory in self.listing:
+            return name in self.listing[directory]
+        return os.path.exists(path)
+
+    def getsize(self, path):
+        if path not in self.sizes:
+            self.sizes[path] = os.path.getsize(path)
+        return self.sizes[path]
 
     def needs_to_be_generated(self, source, target, options):
-        if not os.path.exists(target):
+        if not self.exists(target):
             logger.debug("%s does not exist. Requesting generation...", target)
             return True
 
@@ -49,7 +74,7 @@ class Cache:
 
         cached_picture = self.cache[target]
 
-        if cached_picture["size"] != os.path.getsize(source):
+        if cached_picture["size"] != self.getsize(source):
             logger.debug(
                 "%s has different size than in cache. Requesting generation...", target
             )
@@ -71,8 +96,12 @@ class Cache:
         return False
 
     def cache_picture(self, source, target, options):
+        directory, name = os.path.split(target)
+        if directory in self.listing:
+            self.listing[directory].add(name)
+
         self.cache[target] = {
-            "size": os.path.getsize(source),
+            "size": self.getsize(source),
             "options": remove_superficial_options(options),
         }
 
@@ -2,12 +2,13 @@ import imagesize
 import logging
 import re
 import sys
+import threading
 
 from json import dumps as json_dumps
 from pathlib import Path
 from zlib import crc32
 
-from .utils import remove_superficial_options
+from .utils import remove_superficial_options, source_path
 
 
 logger = logging.getLogger("recitale." + __name__)
@@ -77,13 +78,20 @@ class BaseImage(ImageCommon):
 
     def thumbnail(self, size):
         thumbnail = Thumbnail(self.filepath, self.chksum_opt, size)
-        return self.thumbnails.setdefault(thumbnail.filepath, thumbnail).filepath.name
+        # See ImageFactory.lock
+        with ImageFactory.lock:
+            thumbnail = self.thumbnails.setdefault(thumbnail.filepath, thumbnail)
+        return thumbnail.filepath.name
 
 
 # TODO: add support for looking into parent directories (name: ../other_gallery/pic.jpg)
 class ImageFactory:
     base_imgs = dict()
     global_options = dict()
+    # Galleries are processed in parallel threads (see main()) and may share base images, so
+    # lookups and insertions in base_imgs and in the thumbnails of base images must not
+    # interleave. Same for the other factories.
+    lock = threading.Lock()
 
     @classmethod
     def get(cls, path, image):
@@ -99,8 +107,7 @@ class ImageFactory:
             sys.exit(1)
 
         im = image.copy()
-        # To resolve paths with .. in them, we need to resolve the path first and then
-        # find the relative path to the source (current) directory.
-        im["name"] = Path(path).joinpath(im["name"]).resolve().relative_to(Path.cwd())
+        im["name"] = source_path(path, im["name"])
         img = BaseImage(im, cls.global_options)
-        return cls.base_imgs.setdefault(img.filepath / str(img.chksum_opt), img)
+        with cls.lock:
+            return cls.base_imgs.setdefault(img.filepath / str(img.chksum_opt), img)
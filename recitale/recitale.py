@@ -2,6 +2,7 @@
 
 from argparse import ArgumentParser, ArgumentTypeError
 import logging
+import math
 import os
 import shutil
 import shlex
@@ -10,19 +11,30 @@ import subprocess
 import sys
 import http.server
 import struct
+import threading
+
+from functools import lru_cache
+from glob import glob
+from itertools import repeat
 
 from babel.core import default_locale
 from babel.dates import format_date
-from multiprocessing import Pool, Manager, Process
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from PIL import Image, ImageOps, JpegImagePlugin, ImageFile
 from tqdm import tqdm
 
+try:
+    import pyvips
+except (ImportError, OSError):
+    # pyvips is optional, and raises OSError if libvips cannot be found
+    pyvips = None
+
 from path import Path
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 
 from .cache import CACHE
-from .utils import encrypt, rfc822, load_settings, CustomFormatter
+from .utils import encrypt, rfc822, load_settings, write_if_changed, CustomFormatter
 from .autogen import autogen
 from .__init__ import __version__
 from .image import ImageFactory
@@ -57,8 +69,8 @@ parser_build.add_argument(
     "--jobs",
     default=None,
     type=int,
-    help="Specifies number of jobs (thumbnail generations) to run simultaneously. Default: number "
-    "of threads available on the system",
+    help="Specifies number of jobs (gallery builds, thumbnail generations and video reencodes) to "
+    "run simultaneously. Default: number of threads available on the system",
 )
 subparser.add_parser("test", help="Verify all your yaml data")
 subparser.add_parser("preview", help="Start preview webserver on port 9000")
@@ -123,6 +135,36 @@ SETTINGS = {
 }
 
 
+ENVIRONMENTS = {}
+
+# Dimension big enough to never be the limiting one when fitting an image in a box
+IGNORE_DIM = 65596
+
+# Progressive encoding is much slower than baseline for a negligible benefit on small images, so
+# images with fewer pixels than this are always saved as baseline.
+PROGRESSIVE_MIN_PIXELS = 512 * 512
+
+# Maximum number of videos rendered by a single ffmpeg run. Batching saves spawning ffmpeg for
+# each video but videos of a batch are decoded and encoded in lockstep by one process, so keep
+# batches small for videos of big galleries to still be rendered by several processes at once.
+VIDEO_BATCH_SIZE = 4
+
+# Set when reencodes are interrupted (e.g. Ctrl+C) or fail, so that no new ffmpeg process is
+# started by the ones still running while the build is being stopped.
+INTERRUPTED = threading.Event()
+
+# Transposition to apply to an image to make it upright, per EXIF orientation
+ORIENTATION_TRANSPOSE = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+
 AudioFactory.global_options = SETTINGS["ffmpeg_audio"]
 ImageFactory.global_options = SETTINGS["gm"]
 VideoFactory.global_options = SETTINGS["ffmpeg"]
@@ -186,6 +228,9 @@ def get_settings():
     return settings
 
 
+# Environments of all themes using the same date locale share the same filter, and the default
+# locale is only looked up once.
+@lru_cache(maxsize=None)
 def get_local_date_filter(date_locale):
     if date_locale is None:
         date_locale = default_locale("LC_TIME")
@@ -196,22 +241,30 @@ def get_local_date_filter(date_locale):
     return local_date
 
 
-def get_gallery_templates(
-    theme, gallery_path="", parent_templates=None, date_locale=None
-):
-    theme_path = Path(__file__).parent.joinpath("themes", theme).exists()
-
-    available_themes = theme, "', '".join(
-        Path(__file__).parent.joinpath("themes").listdir()
+def get_bytecode_cache():
+    # Compiled templates are stored on disk so that subsequent builds don't need to parse and
+    # compile them again. Jinja checks the template source checksum before reusing the bytecode.
+    # An empty XDG_CACHE_HOME must be ignored, like an unset one
+    cache_dir = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "recitale",
+        "jinja",
     )
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+    except OSError as e:
+        logger.debug("Cannot create template cache directory %s: %s", cache_dir, e)
+        return None
+
+    return FileSystemBytecodeCache(cache_dir)
 
-    if not theme_path:
-        logger.error(
-            "'%s' is not an existing theme + available themes are '%s'",
-            theme_path,
-            available_themes,
-        )
-        sys.exit(1)
+
+def get_templates_environment(theme, date_locale=None):
+    # Environments cache the templates they compile, so share them between all galleries using
+    # the same theme and date locale instead of parsing and compiling templates again for each.
+    key = (theme, date_locale)
+    if key in ENVIRONMENTS:
+        return ENVIRONMENTS[key]
 
     templates_dir = [
         Path(".").joinpath("templates").realpath(),
@@ -223,26 +276,85 @@ def get_gallery_templates(
             Path(__file__).parent.joinpath("themes", "exposure", "templates")
         )
 
-    subgallery_templates = Environment(
-        loader=FileSystemLoader(templates_dir), trim_blocks=True
+    templates = Environment(
+        # Template filenames end up in the compiled bytecode, which can only be cached if they
+        # are of str type.
+        loader=FileSystemLoader([str(d) for d in templates_dir]),
+        trim_blocks=True,
+        bytecode_cache=get_bytecode_cache(),
+        # Templates don't change during a build, so there's no need to check whether their
+        # source was modified each time one is fetched (e.g. form.html and encrypted.html for
+        # each password-protected gallery).
+        auto_reload=False,
     )
-    subgallery_templates.filters["rfc822"] = rfc822
-    subgallery_templates.filters["local_date"] = get_local_date_filter(date_locale)
+    templates.filters["rfc822"] = rfc822
+    templates.filters["local_date"] = get_local_date_filter(date_locale)
+
+    ENVIRONMENTS[key] = templates
+    return templates
+
 
+def link_or_copy(src, dst):
+    # Static files are identical for all galleries, hardlinking them is much cheaper than copying
+    # their content. Fallback to copying when hardlinks aren't possible (e.g. build directory on
+    # another filesystem, or filesystem not supporting hardlinks).
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def replace_file(src, directory):
+    # Files in build/static may be hardlinks to the theme or to the user's static directory (see
+    # link_or_copy()), writing to them would modify their source too, or fail if src is their
+    # source. Remove them first so that a new file is created instead.
+    dst = Path(directory).joinpath(Path(src).name)
+    dst.remove_p()
+    return shutil.copy2(src, dst)
+
+
+def sync_static(theme, gallery_path=""):
+    # The previous static directory needs to be removed first: copying over a hardlinked file
+    # would modify its source too.
     Path(".").joinpath("build", gallery_path, "static").rmtree_p()
 
     if Path(".").joinpath("static").exists():
         shutil.copytree(
             Path(".").joinpath("static"),
             Path(".").joinpath("build", gallery_path, "static"),
+            copy_function=link_or_copy,
         )
 
     else:
         shutil.copytree(
             Path(__file__).parent.joinpath("themes", theme, "static"),
             Path(".").joinpath("build", gallery_path, "static"),
+            copy_function=link_or_copy,
         )
 
+
+def get_gallery_templates(
+    theme, gallery_path="", parent_templates=None, date_locale=None
+):
+    theme_path = Path(__file__).parent.joinpath("themes", theme).exists()
+
+    available_themes = theme, "', '".join(
+        Path(__file__).parent.joinpath("themes").listdir()
+    )
+
+    if not theme_path:
+        logger.error(
+            "'%s' is not an existing theme + available themes are '%s'",
+            theme_path,
+            available_themes,
+        )
+        sys.exit(1)
+
+    subgallery_templates = get_templates_environment(theme, date_locale)
+
+    sync_static(theme, gallery_path)
+
     return subgallery_templates
 
 
@@ -380,17 +492,11 @@ def __build_gallery(
         name=gallery_path.split("/", 1)[-1],
     ).encode("Utf-8")
 
-    open(Path("build").joinpath(target_gallery_path, "index.html"), "wb").write(html)
-
     if gallery_settings.get("password") or settings.get("password"):
         password = gallery_settings.get("password", settings.get("password"))
-        html = encrypt(
-            password, template, target_gallery_path, settings, gallery_settings
-        )
+        html = encrypt(password, template, html, settings, gallery_settings)
 
-        open(Path("build").joinpath(target_gallery_path, "index.html"), "wb").write(
-            html
-        )
+    write_if_changed(Path("build").joinpath(target_gallery_path, "index.html"), html)
 
 
 def build_gallery(settings, gallery_settings, gallery_path, template):
@@ -426,14 +532,11 @@ def build_index(
     reverse = gallery_settings.get(
         "reverse", settings["settings"].get("reverse", False)
     )
-    if reverse:
-        galleries_cover = sorted(
-            [x for x in galleries_cover if x != {}], key=lambda x: x["date"]
-        )
-    else:
-        galleries_cover = reversed(
-            sorted([x for x in galleries_cover if x != {}], key=lambda x: x["date"])
-        )
+    galleries_cover = sorted(
+        [x for x in galleries_cover if x != {}], key=lambda x: x["date"]
+    )
+    if not reverse:
+        galleries_cover.reverse()
 
     html = index_template.render(
         settings=settings,
@@ -443,13 +546,11 @@ def build_index(
         Video=VideoFactory,
     ).encode("Utf-8")
 
-    open(Path("build").joinpath(gallery_path, "index.html"), "wb").write(html)
-
     if settings.get("password"):
         password = settings.get("password")
-        html = encrypt(password, templates, gallery_path, settings, None)
+        html = encrypt(password, templates, html, settings, None)
 
-        open(Path("build").joinpath(gallery_path, "index.html"), "wb").write(html)
+    write_if_changed(Path("build").joinpath(gallery_path, "index.html"), html)
 
 
 def image_params(img, options):
@@ -465,28 +566,105 @@ def image_params(img, options):
     if format == "JPEG" or format == "MPO":
         params["subsampling"] = JpegImagePlugin.get_sampling(img)
 
-    exif = img.getexif()
-    if exif:
-        params["exif"] = exif
-
     return params
 
 
-def noncached_images(base):
-    img = Image.open(base.filepath)
-    params = image_params(img, base.options)
+def draft_size(img, sizes, orientation=1):
+    # Orientations 5 to 8 swap width and height once transposed, and thumbnail sizes apply to
+    # the transposed image.
+    width, height = img.size
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width
+
+    scale = 0
+    for w, h in sizes:
+        # Thumbnails with both dimensions specified are saved as-is, without resizing, so they
+        # need the image decoded at full size.
+        if w and h:
+            return None
+        scale = max(scale, w / width if w else h / height)
+
+    # Keep twice as many pixels as the biggest thumbnail needs so that LANCZOS still has enough
+    # data to work with, like Image.thumbnail() does with its reducing_gap. Image.thumbnail()
+    # actually drafts the image by itself when it isn't loaded yet, so the returned size only
+    # needs to be passed to Image.draft() for images that are loaded before, e.g. to rotate them.
+    scale = 2 * scale
+    if scale >= 1:
+        return None
+
+    width, height = img.size
+    return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
 
-    if params.get("exif") and base.options.get("strip", False):
-        del params["exif"]
+
+def noncached_images(base):
+    # Image.open() only parses the image header which is enough to get the parameters the cache
+    # depends on.
+    with Image.open(base.filepath) as img:
+        params = image_params(img, base.options)
 
     for thumbnail in base.thumbnails.values():
         filepath = Path("build") / thumbnail.filepath
 
         if CACHE.needs_to_be_generated(base.filepath, str(filepath), params):
-            noncached_images.queue.put(1)
             return base
 
-    noncached_images.queue.put(1)
+
+def orient_image(base, img, params, orientation):
+    logger.debug(
+        "(%s) Orientation EXIF tag set to %d: rotating thumbnails",
+        base.filepath,
+        orientation,
+    )
+
+    try:
+        return ImageOps.exif_transpose(img)
+    except (TypeError, struct.error) as e:
+        # Work-around for Pillow < 7.2.0 because of broken handling of some exif metadata
+        # Fixed with https://github.com/python-pillow/Pillow/pull/4637
+        # Work-around for Pillow < 7.0.0 not handling StripByteCounts being of type long
+        # Fixed with https://github.com/python-pillow/Pillow/pull/4626
+        method = ORIENTATION_TRANSPOSE.get(orientation)
+        if not base.options.get("strip", False) and "exif" in params:
+            logger.warning(
+                "(%s) Original image contains EXIF metadata that Pillow < %s cannot "
+                "handle. Consider upgrading to a newer release. The image will be "
+                "forcefully stripped of its EXIF metadata as a work-around.",
+                base.filepath,
+                "7.2.0" if isinstance(e, TypeError) else "7.0.0",
+            )
+            del params["exif"]
+        return img.transpose(method)
+
+
+def vips_thumbnail(base, size, filepath, params):
+    width, height = size
+    autorotate = base.options.get("auto-orient", False)
+
+    if width and height:
+        # Saved as-is, see draft_size()
+        im = pyvips.Image.new_from_file(str(base.filepath))
+        if autorotate:
+            im = im.autorot()
+    else:
+        im = pyvips.Image.thumbnail(
+            str(base.filepath),
+            width or IGNORE_DIM,
+            height=height or IGNORE_DIM,
+            size="down",
+            no_rotate=not autorotate,
+        )
+
+    options = {
+        "strip": base.options.get("strip", False),
+        "interlace": params.get("progressive", False)
+        and im.width * im.height >= PROGRESSIVE_MIN_PIXELS,
+        # Keep the chroma subsampling of the original image, like Pillow does
+        "subsample_mode": {0: "off", 2: "on"}.get(params.get("subsampling"), "auto"),
+    }
+    if "quality" in params:
+        options["Q"] = params["quality"]
+
+    im.write_to_file(str(filepath), **options)
 
 
 def render_thumbnails(base):
@@ -495,57 +673,80 @@ def render_thumbnails(base):
     img = Image.open(base.filepath)
     params = image_params(img, base.options)
 
-    exif = params.get("exif")
+    # EXIF metadata aren't part of the cache key, so the uncached thumbnails can be listed before
+    # parsing them and bail out early if there's nothing to generate.
+    thumbnails = [
+        thumbnail
+        for thumbnail in base.thumbnails.values()
+        if CACHE.needs_to_be_generated(
+            base.filepath, str(Path("build") / thumbnail.filepath), params
+        )
+    ]
+    if not thumbnails:
+        return
+
+    # libvips shrinks JPEGs while decoding them and streams decoding, resizing and encoding
+    # through multiple threads, which makes it much faster than Pillow. Use it when available.
+    if pyvips and img.format == "JPEG":
+        for thumbnail in thumbnails:
+            filepath = Path("build") / thumbnail.filepath
+            logger.debug(
+                "(%s) Creating thumbnail %s with libvips: size=%s",
+                base.filepath,
+                filepath,
+                thumbnail.size,
+            )
+            vips_thumbnail(base, thumbnail.size, filepath, params)
+            CACHE.cache_picture(base.filepath, str(filepath), params)
+        return
+
+    exif = img.getexif()
+    if exif:
+        params["exif"] = exif
 
     # Re-orient if requested and if Orientation EXIF metadata stored in 0x0112 states that
     # it's not upright.
-    if exif and base.options.get("auto-orient", False) and exif.get(0x0112, 1) != 1:
-        orientation = exif.get(0x0112)
-
-        logger.debug(
-            "(%s) Orientation EXIF tag set to %d: rotating thumbnails",
-            base.filepath,
-            orientation,
-        )
+    orientation = 1
+    if exif and base.options.get("auto-orient", False):
+        orientation = exif.get(0x0112, 1)
+
+    # JPEG can be decoded at 1/2, 1/4 or 1/8 of its resolution for almost free but only before
+    # the image is actually loaded. Thumbnails small enough to benefit from it are rendered from
+    # the re-opened file, the others are copied from the image decoded once at full resolution,
+    # as for other formats.
+    drafts = [
+        draft_size(img, [thumbnail.size], orientation) if img.format == "JPEG" else None
+        for thumbnail in thumbnails
+    ]
 
-        try:
-            img = ImageOps.exif_transpose(img)
-        except (TypeError, struct.error) as e:
-            # Work-around for Pillow < 7.2.0 because of broken handling of some exif metadata
-            # Fixed with https://github.com/python-pillow/Pillow/pull/4637
-            # Work-around for Pillow < 7.0.0 not handling StripByteCounts being of type long
-            # Fixed with https://github.com/python-pillow/Pillow/pull/4626
-            method = {
-                2: Image.FLIP_LEFT_RIGHT,
-                3: Image.ROTATE_180,
-                4: Image.FLIP_TOP_BOTTOM,
-                5: Image.TRANSPOSE,
-                6: Image.ROTATE_270,
-                7: Image.TRANSVERSE,
-                8: Image.ROTATE_90,
-            }.get(orientation)
-            img = img.transpose(method)
-            if not base.options.get("strip", False):
-                logger.warning(
-                    "(%s) Original image contains EXIF metadata that Pillow < %s cannot "
-                    "handle. Consider upgrading to a newer release. The image will be "
-                    "forcefully stripped of its EXIF metadata as a work-around.",
-                    base.filepath,
-                    "7.2.0" if isinstance(e, TypeError) else "7.0.0",
-                )
-                del params["exif"]
+    if not all(drafts) and orientation != 1:
+        img = orient_image(base, img, params, orientation)
 
     if params.get("exif") and base.options.get("strip", False):
         del params["exif"]
 
-    for thumbnail in base.thumbnails.values():
-        filepath = Path("build") / thumbnail.filepath
+    if params.get("exif") and orientation != 1:
+        # Thumbnails are already upright, viewers must not rotate them once more. The EXIF
+        # metadata aren't those of re-opened images, whose orientation still needs to be read.
+        del params["exif"][0x0112]
 
-        if not CACHE.needs_to_be_generated(base.filepath, str(filepath), params):
-            continue
+    for thumbnail, draft in zip(thumbnails, drafts):
+        filepath = Path("build") / thumbnail.filepath
 
-        # Needed because im.thumbnail replaces the original image
-        im = img.copy()
+        if draft:
+            im = Image.open(base.filepath)
+            if orientation != 1:
+                # im.thumbnail() drafts the image by itself, but only if it isn't loaded yet,
+                # which orient_image() does.
+                logger.debug("(%s) Decoding at reduced size %s", base.filepath, draft)
+                im.draft(im.mode, draft)
+                im = orient_image(base, im, params, orientation)
+        elif all(thumbnail.size):
+            # Saved as-is (see draft_size()), so the decoded image can be used directly
+            im = img
+        else:
+            # Needed because im.thumbnail replaces the original image
+            im = img.copy()
 
         width, height = thumbnail.size
 
@@ -556,7 +757,6 @@ def render_thumbnails(base):
             # When only one dimension is specified, the other should thus be
             # outrageously big so that the thumbnail dimension will always be
             # of the specified value.
-            IGNORE_DIM = 65596
             height = height if height is not None else IGNORE_DIM
             width = width if width is not None else IGNORE_DIM
             im.thumbnail((width, height), Image.LANCZOS)
@@ -567,8 +767,12 @@ def render_thumbnails(base):
             filepath,
             thumbnail.size,
         )
+        save_params = params
+        if params.get("progressive") and im.width * im.height < PROGRESSIVE_MIN_PIXELS:
+            save_params = dict(params, progressive=False)
+
         try:
-            im.save(filepath, **params)
+            im.save(filepath, **save_params)
         except OSError as e:
             # Work-around for:
             # https://github.com/python-pillow/Pillow/issues/148
@@ -588,7 +792,7 @@ def render_thumbnails(base):
                 ImageFile.MAXBLOCK,
                 (4 * width * height) + len(im.info.get("icc_profile", "")) + 10,
             )
-            im.save(filepath, **params)
+            im.save(filepath, **save_params)
         except TypeError as e:
             # Work-around for Pillow < 7.2.0 because of broken handling of some exif metadata
             # Fixed with https://github.com/python-pillow/Pillow/pull/4637
@@ -601,7 +805,8 @@ def render_thumbnails(base):
                 e,
             )
             del params["exif"]
-            im.save(filepath, **params)
+            save_params.pop("exif", None)
+            im.save(filepath, **save_params)
 
         logger.debug(
             "(%s) Done creating thumbnail %s: size=%s",
@@ -610,94 +815,135 @@ def render_thumbnails(base):
             thumbnail.size,
         )
         CACHE.cache_picture(base.filepath, str(filepath), params)
-    render_thumbnails.queue.put(1)
 
 
-def render_video(base):
-    logger.debug("(%s) Rendering thumbnails and reencodes", base.filepath)
-    basecmd = "{binary} -loglevel {loglevel} -y -i " + shlex.quote(str(base.filepath))
+def video_outputs(base, index):
+    # Output options apply to the output file following them, and -map selects the streams from
+    # the index-th input file to store in that output.
+    options = base.options
+    uncached = []
+    command = []
+    for reencode in base.reencodes.values():
+        filepath = Path("build") / reencode.filepath
+        if not CACHE.needs_to_be_generated(base.filepath, str(filepath), options):
+            continue
 
-    if base.reencodes:
-        reencodecmd = (
-            basecmd
-            + " -stats -c:v {video} -b:v {vbitrate} {other} -c:a {audio} -b:a {abitrate} "
-            + "-f {format} "
+        width, height = reencode.size
+        width = width if width else -1
+        height = height if height else -1
+        command.extend(
+            [
+                "-map",
+                "%d:v:0" % index,
+                "-map",
+                "%d:a:0?" % index,
+                "-c:v",
+                str(options["video"]),
+                "-b:v",
+                str(options["vbitrate"]),
+                *shlex.split(str(options["other"])),
+                "-c:a",
+                str(options["audio"]),
+                "-b:a",
+                str(options["abitrate"]),
+                "-f",
+                str(options["format"]),
+                "-s",
+                "%sx%s" % (width, height),
+                str(filepath),
+            ]
         )
-        for reencode in base.reencodes.values():
-            logger.info("Reencoding (%s)" % base.filepath)
-            filepath = Path("build") / reencode.filepath
-            if not CACHE.needs_to_be_generated(
-                base.filepath, str(filepath), base.options
-            ):
-                continue
-
-            width, height = reencode.size
-            width = width if width else -1
-            height = height if height else -1
-            command = (
-                reencodecmd
-                + "-s "
-                + str(width)
-                + "x"
-                + str(height)
-                + " "
-                + shlex.quote(str(filepath))
-            )
-            command = command.format(**base.options)
-
-            if subprocess.run(shlex.split(command)).returncode != 0:
-                logger.error(
-                    "An error occured while rendering reencodes for %s", base.filepath
-                )
-                return
-
-            CACHE.cache_picture(base.filepath, str(filepath), base.options)
+        uncached.append(filepath)
 
-    if not base.thumbnails:
-        return
+    if uncached:
+        logger.info("Reencoding (%s)" % base.filepath)
 
-    uncached = []
-    command = ""
     for thumbnail in base.thumbnails.values():
         filepath = Path("build") / thumbnail.filepath
-        if not CACHE.needs_to_be_generated(base.filepath, str(filepath), base.options):
+        if not CACHE.needs_to_be_generated(base.filepath, str(filepath), options):
             continue
 
         width, height = thumbnail.size
         width = width if width else -1
         height = height if height else -1
-        command = (
-            command
-            + " -frames:v 1 -vf scale="
-            + str(width)
-            + ":"
-            + str(height)
-            + " "
-            + shlex.quote(str(filepath))
+        command.extend(
+            [
+                "-map",
+                "%d:v:0" % index,
+                "-frames:v",
+                "1",
+                "-vf",
+                "scale=%s:%s" % (width, height),
+                str(filepath),
+            ]
         )
-        uncached.append(thumbnail)
+        uncached.append(filepath)
+
+    return command, uncached
+
+
+def render_videos(bases):
+    # ffmpeg supports multiple input files and multiple outputs, each output having its own
+    # options. Spawning ffmpeg is expensive, so all uncached reencodes and thumbnails of a batch
+    # of videos are generated in one run.
+    inputs = []
+    outputs = []
+    uncached = []
+    stats = False
+    for base in bases:
+        logger.debug("(%s) Rendering thumbnails and reencodes", base.filepath)
+        command, filepaths = video_outputs(base, len(inputs))
+        if not filepaths:
+            continue
+
+        stats = stats or bool(base.reencodes)
+        inputs.append(base)
+        outputs.extend(command)
+        uncached.extend((base, filepath) for filepath in filepaths)
 
-    if not uncached:
+    if not inputs or INTERRUPTED.is_set():
         return
 
-    command = basecmd + command
-    command = command.format(**base.options)
-    if subprocess.run(shlex.split(command)).returncode != 0:
+    options = inputs[0].options
+    command = [options["binary"], "-loglevel", str(options["loglevel"]), "-y"]
+    if stats:
+        command.append("-stats")
+    for base in inputs:
+        command.extend(["-i", str(base.filepath)])
+    command.extend(outputs)
+
+    returncode = subprocess.run(command).returncode
+    if returncode != 0:
+        # Ctrl+C reaches ffmpeg too, which then exits with 255, or with a negative code when
+        # killed by a signal. Only retry real encoding failures.
+        interrupted = returncode < 0 or returncode == 255 or INTERRUPTED.is_set()
+        if len(inputs) > 1 and not interrupted:
+            # A single broken video makes the whole run fail. Render videos one by one so that
+            # the outputs of the other ones are still generated and cached.
+            logger.warning(
+                "An error occured while rendering thumbnails and reencodes for %s, retrying "
+                "one video at a time",
+                ", ".join(str(base.filepath) for base in inputs),
+            )
+            for base in inputs:
+                render_videos([base])
+            return
+
         logger.error(
-            "An error occured while rendering thumbnails for %s", str(base.filepath)
+            "An error occured while rendering thumbnails and reencodes for %s",
+            ", ".join(str(base.filepath) for base in inputs),
         )
         return
 
-    for thumbnail in uncached:
+    for base, filepath in uncached:
         CACHE.cache_picture(base.filepath, str(filepath), base.options)
 
 
 def reencode_audio(base):
     logger.debug("(%s) Rendering reencodes", base.filepath)
-    basecmd = "{binary} -loglevel {loglevel} -stats -i " + shlex.quote(
-        str(base.filepath)
-    )
-    basecmd = basecmd + " -c:a {audio} -y "
+    options = base.options
+    basecmd = [options["binary"], "-loglevel", str(options["loglevel"]), "-stats"]
+    basecmd.extend(["-i", str(base.filepath), "-c:a", str(options["audio"]), "-y"])
 
     if not base.reencodes:
         return
@@ -709,10 +955,7 @@ def reencode_audio(base):
             logger.info("Skipped: %s is already generated", reencode.filepath)
             return
 
-        command = basecmd + shlex.quote(filepath)
-        command = command.format(**base.options)
-
-        if subprocess.run(shlex.split(command)).returncode != 0:
+        if subprocess.run(basecmd + [str(filepath)]).returncode != 0:
             logger.error(
                 "An error occured while rendering reencodes for %s", base.filepath
             )
@@ -721,6 +964,109 @@ def reencode_audio(base):
         CACHE.cache_picture(base.filepath, str(filepath), base.options)
 
 
+def generate_thumbnails(jobs):
+    # Pillow releases the GIL while decoding, resizing and encoding images, so threads scale
+    # just as well as processes here without the cost of forking, pickling BaseImage objects
+    # back and forth or spawning a Manager process for the progress bars.
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as executor:
+        logger.info("Generating thumbnails...")
+
+        # Images are first quickly checked against the cache so that only images with at
+        # least one thumbnail to create are rendered. Rendering of an image is submitted as
+        # soon as its check is done instead of waiting for all images to be checked, so that
+        # the slowest checks don't delay rendering.
+        # Biggest images take the longest to render, so start with them and let the small
+        # ones fill the gaps at the end instead of having one big image render last, alone.
+        # The file size is cheap to get and a good enough estimate of the number of pixels.
+        bases = sorted(
+            ImageFactory.base_imgs.values(),
+            key=lambda base: CACHE.getsize(base.filepath),
+            reverse=True,
+        )
+        pending = {executor.submit(noncached_images, base) for base in bases}
+        try:
+            with tqdm(
+                total=len(pending),
+                desc="Generating thumbnails",
+                bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} | ETA: {remaining}",
+            ) as pbar:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # noncached_images() returns the image if it needs to be rendered,
+                        # None if it is fully cached. render_thumbnails() always returns None.
+                        base = future.result()
+                        if base:
+                            pending.add(executor.submit(render_thumbnails, base))
+                        else:
+                            pbar.update()
+        except BaseException:
+            # Leaving the executor waits for all submitted tasks to be run, so cancel the ones
+            # not started yet on errors and interruptions (Ctrl+C) for the build to stop quickly.
+            for future in pending:
+                future.cancel()
+            raise
+
+
+def generate_reencodes(jobs):
+    # ffmpeg is already multithreaded, so only run half as many ffmpeg processes at once as
+    # there are jobs to avoid them competing for the same CPUs.
+    with ThreadPoolExecutor(max(1, (jobs or os.cpu_count() or 1) // 2)) as executor:
+        # One ffmpeg run per batch of videos of the same directory
+        videos = {}
+        for video in VideoFactory.base_vids.values():
+            key = (
+                video.filepath.parent,
+                video.options["binary"],
+                video.options["loglevel"],
+            )
+            videos.setdefault(key, []).append(video)
+        batches = [
+            group[i : i + VIDEO_BATCH_SIZE]
+            for group in videos.values()
+            for i in range(0, len(group), VIDEO_BATCH_SIZE)
+        ]
+
+        # Videos and audio files are all queued at once so that audio reencodes can start as
+        # soon as a worker is free instead of waiting for all videos to be done.
+        video_futures = {
+            executor.submit(render_videos, batch): batch for batch in batches
+        }
+        audio_futures = [
+            executor.submit(reencode_audio, base)
+            for base in AudioFactory.base_audios.values()
+        ]
+
+        try:
+            # Progress bars are updated in completion order, not submission order, so that a long
+            # reencode doesn't hide the progress of the ones submitted after it.
+            if video_futures:
+                # Count videos, not batches
+                with tqdm(
+                    total=len(VideoFactory.base_vids),
+                    desc="Generating video thumbnails and resizes",
+                ) as progress:
+                    for future in as_completed(video_futures):
+                        future.result()
+                        progress.update(len(video_futures[future]))
+
+            if audio_futures:
+                for future in tqdm(
+                    as_completed(audio_futures),
+                    total=len(audio_futures),
+                    desc="Generating audio reencodes",
+                ):
+                    future.result()
+        except BaseException:
+            # Don't start new ffmpeg processes for the queued videos and audio files on errors
+            # and interruptions (Ctrl+C), leaving the executor would wait for all of them. Batches
+            # already being rendered must not retry their videos one by one either.
+            for future in list(video_futures) + audio_futures:
+                future.cancel()
+            INTERRUPTED.set()
+            raise
+
+
 logger = logging.getLogger("recitale")
 
 
@@ -734,8 +1080,6 @@ def main():
 
     settings = get_settings()
 
-    front_page_galleries_cover = []
-
     galleries_dirs = [
         x for x in Path(".").listdir() if x.joinpath("settings.yaml").exists()
     ]
@@ -786,18 +1130,16 @@ def main():
         if settings["settings"]["deploy"]["ssh"]:
             r_username = settings["settings"]["deploy"]["username"]
             r_hostname = settings["settings"]["deploy"]["hostname"]
-            r_cmd = "rsync -avz --progress %s build/* %s@%s:%s" % (
-                shlex.quote(r_others),
-                shlex.quote(r_username),
-                shlex.quote(r_hostname),
-                shlex.quote(r_dest),
-            )
-        else:
-            r_cmd = "rsync -avz --progress %s build/* %s" % (
-                shlex.quote(r_others),
-                shlex.quote(r_dest),
-            )
-        if subprocess.run(shlex.split(r_cmd)).returncode != 0:
+            r_dest = "%s@%s:%s" % (r_username, r_hostname, r_dest)
+        # Without any source, rsync would only list the destination and succeed
+        r_sources = sorted(glob("build/*"))
+        if not r_sources:
+            logger.error("Nothing to deploy, the build directory is empty")
+            sys.exit(1)
+        r_cmd = ["rsync", "-avz", "--progress", *shlex.split(r_others)]
+        r_cmd.extend(r_sources)
+        r_cmd.append(r_dest)
+        if subprocess.run(r_cmd).returncode != 0:
             logger.error("deployment failed")
             sys.exit(1)
         return
@@ -810,27 +1152,39 @@ def main():
     theme = settings["settings"].get("theme", "exposure")
     date_locale = settings["settings"].get("date_locale")
     templates = get_gallery_templates(theme, date_locale=date_locale)
-    templates.add_extension("jinja2.ext.with_")
 
     if Path("custom.js").exists():
-        shutil.copy(Path("custom.js"), Path(".").joinpath("build", "", "static", "js"))
+        replace_file("custom.js", Path(".").joinpath("build", "static", "js"))
         settings["custom_js"] = True
 
     if Path("custom.css").exists():
-        shutil.copy(
-            Path("custom.css"), Path(".").joinpath("build", "", "static", "css")
-        )
+        replace_file("custom.css", Path(".").joinpath("build", "static", "css"))
         settings["custom_css"] = True
 
+    # If recitale is started without any argument, 'build' is assumed but the jobs parameter
+    # is not part of the namespace (neither is it for 'test'), so set its default to None (or
+    # 'number of available CPU treads')
+    jobs = getattr(args, "jobs", None)
+
     logger.info("Building galleries...")
 
-    for gallery in tqdm(
-        galleries_dirs,
-        desc="Building galleries",
-        bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} | ETA: {remaining}",
-    ):
-        front_page_galleries_cover.append(
-            process_directory(gallery.normpath(), settings, templates)
+    # Galleries are independent from each other, so build them in parallel to overlap reading
+    # settings, rendering templates and copying static files.
+    with ThreadPoolExecutor(
+        min(jobs or os.cpu_count() or 1, len(galleries_dirs))
+    ) as executor:
+        front_page_galleries_cover = list(
+            tqdm(
+                executor.map(
+                    process_directory,
+                    [gallery.normpath() for gallery in galleries_dirs],
+                    repeat(settings),
+                    repeat(templates),
+                ),
+                total=len(galleries_dirs),
+                desc="Building galleries",
+                bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} | ETA: {remaining}",
+            )
         )
 
     for i in includes:
@@ -838,23 +1192,24 @@ def main():
         dstdir = Path(".").joinpath("build", srcdir)
         if srcdir != "":
             os.makedirs(dstdir, exist_ok=True)
-        d = shutil.copy2(i, dstdir)
-        logger.warning("copied", d)
+        d = replace_file(i, dstdir)
+        logger.warning("copied %s", d)
 
     if settings["rss"]:
         feed_template = templates.get_template("feed.xml")
 
+        # Newest galleries first
+        galleries_cover = sorted(
+            [x for x in front_page_galleries_cover if x != {}], key=lambda x: x["date"]
+        )
+        galleries_cover.reverse()
+
         xml = feed_template.render(
             settings=settings,
-            galleries=reversed(
-                sorted(
-                    [x for x in front_page_galleries_cover if x != {}],
-                    key=lambda x: x["date"],
-                )
-            ),
+            galleries=galleries_cover,
         ).encode("Utf-8")
 
-        open(Path("build").joinpath("feed.xml"), "wb").write(xml)
+        write_if_changed(Path("build").joinpath("feed.xml"), xml)
 
     build_index(settings, front_page_galleries_cover, templates)
 
@@ -862,87 +1217,39 @@ def main():
         logger.info("Success: HTML file building without error")
         sys.exit(0)
 
-    # If recitale is started without any argument, 'build' is assumed but the jobs parameter
-    # is not part of the namespace, so set its default to None (or 'number of available CPU
-    # treads')
-    jobs = args.jobs if args.cmd else None
+    outputs = [
+        thumbnail
+        for base in ImageFactory.base_imgs.values()
+        for thumbnail in base.thumbnails.values()
+    ]
+    for base in VideoFactory.base_vids.values():
+        outputs.extend(base.thumbnails.values())
+        outputs.extend(base.reencodes.values())
+    for base in AudioFactory.base_audios.values():
+        outputs.extend(base.reencodes.values())
+    CACHE.prewarm([str(Path("build") / output.filepath) for output in outputs])
+
+    # Pillow's output buffer may be too small for progressive JPEGs with a high quality, in which
+    # case saving fails and is retried with a bigger buffer (see render_thumbnails()). Size it
+    # for the biggest known thumbnail up front so that images are saved only once.
+    max_pixels = max(
+        (
+            thumbnail.size[0] * thumbnail.size[1]
+            for base in ImageFactory.base_imgs.values()
+            if base.options.get("progressive", False)
+            for thumbnail in base.thumbnails.values()
+            if all(thumbnail.size)
+        ),
+        default=0,
+    )
+    ImageFile.MAXBLOCK = max(ImageFile.MAXBLOCK, 4 * max_pixels + 65536)
 
     try:
-
-        def set_queue(initargs):
-            queue, funcs = initargs
-            for func in funcs:
-                func.queue = queue
-
-        pbar_queue = Manager().Queue()
-
-        with Pool(
-            jobs,
-            initializer=set_queue,
-            initargs=((pbar_queue, [noncached_images, render_thumbnails]),),
-        ) as pool:
-
-            def handle_pbar(desc, queue, pbar_len):
-                with tqdm(
-                    total=pbar_len,
-                    desc=desc,
-                    bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} | ETA: {remaining}",
-                ) as pbar:
-                    while queue.get():
-                        pbar.update()
-
-            logger.info("Generating list of thumbnails to create...")
-
-            pbar = Process(
-                target=handle_pbar,
-                args=(
-                    "Filtering cached thumbnails",
-                    pbar_queue,
-                    len(ImageFactory.base_imgs),
-                ),
-            )
-            pbar.start()
-            # Pool splits the iterable into pre-defined chunks which are then assigned to processes.
-            # There is no other scheduling in play after that. This is an issue when chunks are
-            # outrageously unbalanced in terms of CPU time which happens when most galleries are
-            # already built and thus hit the cache but not some, in which case, only a few processes
-            # will run and not the full CPU power will be used, wasting time.
-            # In order to optimize this, a first very quick run through the list of images is done
-            # to list only those which actually need to be generated.
-            # In the following implementation, the first pool.map function will be slightly
-            # unbalanced because some images will hit the cache directly while some won't at all,
-            # iterating over all the thumbnails it needs to create. But it is **much** less
-            # unbalanced than sending to render_thumbnails all images even those which would hit the
-            # cache. After the first pool.map, the second will only contain images with at least one
-            # thumbnail to create.
-            base_imgs = pool.map(noncached_images, ImageFactory.base_imgs.values())
-            pbar_queue.put(None)
-            pbar.join()
-            base_imgs = [img for img in base_imgs if img]
-
-            if base_imgs:
-                logger.info("Generating thumbnails...")
-                pbar = Process(
-                    target=handle_pbar,
-                    args=("Generating thumbnails", pbar_queue, len(base_imgs)),
-                )
-                pbar.start()
-                base_imgs = pool.map(render_thumbnails, base_imgs)
-                pbar_queue.put(None)
-                pbar.join()
-
-        if len(VideoFactory.base_vids):
-            for video in tqdm(
-                VideoFactory.base_vids.values(),
-                desc="Generating video thumbnails and resizes",
-            ):
-                render_video(video)
-
-        if len(AudioFactory.base_audios):
-            for audio in tqdm(
-                AudioFactory.base_audios.values(), desc="Generating audio reencodes"
-            ):
-                reencode_audio(audio)
+        # Skip phases with nothing to render altogether, e.g. on sites without any video.
+        if ImageFactory.base_imgs:
+            generate_thumbnails(jobs)
+        if VideoFactory.base_vids or AudioFactory.base_audios:
+            generate_reencodes(jobs)
     finally:
         CACHE.cache_dump()
 
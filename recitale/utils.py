@@ -1,40 +1,58 @@
 import logging
+import os
 import sys
 import base64
-import shlex
 import subprocess
 from email.utils import formatdate
-from datetime import datetime
+from datetime import date, datetime
 from builtins import str
+from functools import lru_cache
+from hashlib import md5
+from pathlib import Path
 
-from path import Path
 import ruamel.yaml as yaml
 
+try:
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    # cryptography is optional, the openssl binary is used instead
+    Cipher = None
+
 
 logger = logging.getLogger("recitale." + __name__)
 
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+# Options which don't have any impact on the generated thumbnails and reencodes.
+# "resize" only applies to image.copy() in templates, no need to propagate it to the cache since
+# the actual size of the "copy" thumbnail is part of the filename and will trigger a
+# regeneration if changed (thus "resize" setting is appropriately watched without regenerating
+# non-copy thumbnails).
+SUPERFICIAL_OPTIONS = frozenset(
+    ("name", "exif", "text", "type", "size", "float", "resize")
+)
+
 
 def remove_superficial_options(options):
-    cleaned_options = options.copy()
-    if "name" in cleaned_options:
-        del cleaned_options["name"]
-    if "exif" in cleaned_options:
-        del cleaned_options["exif"]
-    if "text" in cleaned_options:
-        del cleaned_options["text"]
-    if "type" in cleaned_options:
-        del cleaned_options["type"]
-    if "size" in cleaned_options:
-        del cleaned_options["size"]
-    if "float" in cleaned_options:
-        del cleaned_options["float"]
-    # "resize" only applies to image.copy() in templates, no need to propagate it to the cache since
-    # the actual size of the "copy" thumbnail is part of the filename and will trigger a
-    # regeneration if changed (thus "resize" setting is appropriately watched without regenerating
-    # non-copy thumbnails).
-    if "resize" in cleaned_options:
-        del cleaned_options["resize"]
-    return cleaned_options
+    return {
+        key: value for key, value in options.items() if key not in SUPERFICIAL_OPTIONS
+    }
+
+
+def source_path(path, name):
+    # The result depends on the current directory, which may change (e.g. preview command).
+    return _source_path(path, name, os.getcwd())
+
+
+# The same files are usually referenced several times (e.g. covers of subgalleries) and resolving
+# a path costs one syscall per component, so resolve each path only once.
+@lru_cache(maxsize=None)
+def _source_path(path, name, cwd):
+    # To resolve paths with .. in them, we need to resolve the path first and then
+    # find the relative path to the source (current) directory.
+    return Path(path).joinpath(name).resolve().relative_to(cwd)
 
 
 class CustomFormatter(logging.Formatter):
@@ -53,32 +71,59 @@ class CustomFormatter(logging.Formatter):
         logging.ERROR: FAIL + fmt_nok + ENDC,
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Parse formats once instead of for each record
+        self.formatters = {
+            level: logging.Formatter(fmt) for level, fmt in self.FORMATS.items()
+        }
+        # Levels without a format of their own (e.g. DEBUG) use the default one
+        self.default_formatter = logging.Formatter()
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
+        formatter = self.formatters.get(record.levelno, self.default_formatter)
         return formatter.format(record)
 
 
 def makeform(template, settings, gallery_settings):
     from_template = template.get_template("form.html")
-    form = base64.b64encode(
-        from_template.render(settings=settings, gallery=gallery_settings).encode(
-            "Utf-8"
-        )
-    )
-    return str(form, "utf-8")
-
-
-def encrypt(password, template, gallery_path, settings, gallery_settings):
+    form = from_template.render(settings=settings, gallery=gallery_settings)
+    # base64 output is ASCII-only
+    return base64.b64encode(form.encode("utf-8")).decode("ascii")
+
+
+def evp_bytes_to_key(password, salt, length):
+    # Key and IV derivation used by openssl enc with -md md5
+    derived = b""
+    block = b""
+    while len(derived) < length:
+        # OpenSSL EVP_BytesToKey compatibility, not used as a security hash
+        block = md5(block + password + salt).digest()  # nosec B324
+        derived = derived + block
+    return derived[:length]
+
+
+def aes_encrypt(password, data):
+    # Same output as `openssl enc -e -base64 -A -aes-256-cbc -md md5` without spawning a process
+    # for each encrypted page.
+    salt = os.urandom(8)
+    derived = evp_bytes_to_key(password.encode("utf-8"), salt, 32 + 16)
+    key, iv = derived[:32], derived[32:]
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    data = padder.update(data) + padder.finalize()
+    ciphertext = encryptor.update(data) + encryptor.finalize()
+    return base64.b64encode(b"Salted__" + salt + ciphertext)
+
+
+def encrypt(password, template, html, settings, gallery_settings):
     encrypted_template = template.get_template("encrypted.html")
-    index_plain = Path("build").joinpath(gallery_path, "index.html")
-    cmd = "openssl enc -e -base64 -A -aes-256-cbc -md md5 -pass pass:%s" % shlex.quote(
-        password
-    )
-    with open(index_plain, "r") as f:
-        encrypted = subprocess.check_output(
-            shlex.split(cmd), stdin=f, stderr=subprocess.DEVNULL
-        )
+    if Cipher:
+        encrypted = aes_encrypt(password, html)
+    else:
+        cmd = ["openssl", "enc", "-e", "-base64", "-A", "-aes-256-cbc", "-md", "md5"]
+        cmd.extend(["-pass", "pass:" + password])
+        encrypted = subprocess.check_output(cmd, input=html, stderr=subprocess.DEVNULL)
     html = encrypted_template.render(
         settings=settings,
         form=makeform(template, settings, gallery_settings),
@@ -88,17 +133,34 @@ def encrypt(password, template, gallery_path, settings, gallery_settings):
     return html
 
 
-def rfc822(date):
-    epoch = datetime.utcfromtimestamp(0).date()
-    return formatdate((date - epoch).total_seconds())
+def write_if_changed(path, data):
+    # Leave files whose content didn't change untouched so that their modification time is kept,
+    # which avoids transferring them again on deployment.
+    try:
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+
+    # Write to a temporary file first so that path is never left half-written.
+    tmp = "%s.tmp" % path
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+    return True
+
+
+def rfc822(value):
+    return formatdate((value.toordinal() - EPOCH_ORDINAL) * 86400)
 
 
 def load_settings(folder):
     try:
-        with open(
-            Path(".").joinpath(folder, "settings.yaml").abspath(), "r"
-        ) as settings:
-            gallery_settings = yaml.safe_load(settings.read())
+        with open(os.path.join(folder, "settings.yaml"), "r") as settings:
+            # Unlike safe_load(), YAML(typ="safe") uses the much faster libyaml-based parser when
+            # available. YAML instances aren't thread-safe so each call gets its own.
+            gallery_settings = yaml.YAML(typ="safe").load(settings)
     except (yaml.error.MarkedYAMLError, yaml.YAMLError) as exc:
         msg = "There is something wrong in %s/settings.yaml" % folder
         if isinstance(exc, yaml.error.MarkedYAMLError):
@@ -1,12 +1,12 @@
 import logging
-import shlex
 import subprocess
+import threading
 
 from json import dumps as json_dumps
 from pathlib import Path
 from zlib import crc32
 
-from .utils import remove_superficial_options
+from .utils import remove_superficial_options, source_path
 
 
 logger = logging.getLogger("recitale." + __name__)
@@ -21,12 +21,9 @@ class VideoCommon:
                 binary = "ffprobe"
             else:
                 binary = "avprobe"
-            command = (
-                binary
-                + " -v error -select_streams v:0 -show_entries stream=width,height -of csv=p=0 "
-                + shlex.quote(str(self.filepath))
-            )
-            out = subprocess.check_output(shlex.split(command))
+            command = [binary, "-v", "error", "-select_streams", "v:0"]
+            command.extend(["-show_entries", "stream=width,height", "-of", "csv=p=0"])
+            out = subprocess.check_output(command + [str(self.filepath)])
             width, height = out.decode("utf-8").split(",")
             self.size = width, height
         else:
@@ -76,23 +73,30 @@ class BaseVideo(VideoCommon):
         reencode = Reencode(
             self.filepath, self.chksum_opt, size, self.options["extension"]
         )
-        return self.reencodes.setdefault(reencode.filepath, reencode).filepath.name
+        # See ImageFactory.lock
+        with VideoFactory.lock:
+            reencode = self.reencodes.setdefault(reencode.filepath, reencode)
+        return reencode.filepath.name
 
     def thumbnail(self, size):
         thumbnail = Thumbnail(self.filepath, self.chksum_opt, size)
-        return self.thumbnails.setdefault(thumbnail.filepath, thumbnail).filepath.name
+        # See ImageFactory.lock
+        with VideoFactory.lock:
+            thumbnail = self.thumbnails.setdefault(thumbnail.filepath, thumbnail)
+        return thumbnail.filepath.name
 
 
 # TODO: add support for looking into parent directories (name: ../other_gallery/pic.jpg)
 class VideoFactory:
     base_vids = dict()
     global_options = dict()
+    # See ImageFactory.lock
+    lock = threading.Lock()
 
     @classmethod
     def get(cls, path, video):
         vid = video.copy()
-        # To resolve paths with .. in them, we need to resolve the path first and then
-        # find the relative path to the source (current) directory.
-        vid["name"] = Path(path).joinpath(vid["name"]).resolve().relative_to(Path.cwd())
+        vid["name"] = source_path(path, vid["name"])
         bvid = BaseVideo(vid, cls.global_options)
-        return cls.base_vids.setdefault(bvid.filepath / str(bvid.chksum_opt), bvid)
+        with cls.lock:
+            return cls.base_vids.setdefault(bvid.filepath / str(bvid.chksum_opt), bvid)
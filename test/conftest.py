@@ -0,0 +1,16 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+
+@pytest.fixture
+def parallel_galleries():
+    # Galleries are built in parallel (see main()) and may share the same media. Build many of
+    # them with gallery(i) and check they all end up with the same objects.
+    def build(gallery, count=64):
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(gallery, range(count)))
+
+        assert all(result == results[0] for result in results)
+        return results[0]
+
+    return build
@@ -151,3 +151,37 @@ class TestCache:
         mock_ospath.assert_called_once()
         mock_ossize.assert_called_once_with("source.jpg")
         mock_options.assert_called_once_with(options)
+
+    def test_prewarm(self, cache, tmp_path):
+        tmp_path.joinpath("thumbnail.jpg").touch()
+        cache.prewarm(
+            [
+                str(tmp_path / "thumbnail.jpg"),
+                str(tmp_path / "missing.jpg"),
+                str(tmp_path / "notfound" / "thumbnail.jpg"),
+            ]
+        )
+
+        assert cache.listing == {str(tmp_path): {"thumbnail.jpg"}}
+
+        with patch("recitale.cache.os.path.exists") as mock_ospath:
+            assert cache.exists(str(tmp_path / "thumbnail.jpg")) is True
+            assert cache.exists(str(tmp_path / "missing.jpg")) is False
+            mock_ospath.assert_not_called()
+
+        assert cache.exists(str(tmp_path / "notfound" / "thumbnail.jpg")) is False
+
+    @patch("recitale.cache.os.path.getsize", return_value=12345678)
+    def test_cache_picture_prewarmed(self, mock_ossize, cache, tmp_path):
+        cache.prewarm([str(tmp_path / "thumbnail.jpg")])
+        assert cache.exists(str(tmp_path / "thumbnail.jpg")) is False
+
+        cache.cache_picture("some.jpg", str(tmp_path / "thumbnail.jpg"), {})
+
+        assert cache.exists(str(tmp_path / "thumbnail.jpg")) is True
+
+    @patch("recitale.cache.os.path.getsize", return_value=12345678)
+    def test_getsize_once(self, mock_ossize, cache):
+        assert cache.getsize("source.jpg") == 12345678
+        assert cache.getsize("source.jpg") == 12345678
+        mock_ossize.assert_called_once_with("source.jpg")
@@ -62,3 +62,12 @@ class TestImageFactory:
         base_imgs = ImageFactory.base_imgs
         assert len(base_imgs.keys()) == 1
         assert img1 == list(base_imgs.values())[0]
+
+    def test_parallel_galleries(self, parallel_galleries):
+        def gallery(i):
+            img = ImageFactory.get("gallery%d" % i, "../shared/test.jpg")
+            return img, img.thumbnail((None, 300))
+
+        img, thumbnail = parallel_galleries(gallery)
+        assert list(ImageFactory.base_imgs.values()) == [img]
+        assert len(img.thumbnails) == 1
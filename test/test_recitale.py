@@ -0,0 +1,557 @@
+import os
+import pytest
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import call, patch
+
+from PIL import Image, JpegImagePlugin
+
+import recitale.recitale
+from recitale.audio import BaseAudio
+from recitale.image import BaseImage, ImageFactory
+from recitale.video import BaseVideo, VideoFactory
+
+OPTIONS = {
+    "binary": "ffmpeg",
+    "loglevel": "error",
+    "format": "webm",
+    "vbitrate": "3900k",
+    "abitrate": "100k",
+    "audio": "libvorbis",
+    "video": "libvpx",
+    "other": "-qmin 10 -qmax 42",
+    "extension": "webm",
+}
+
+
+def video(name):
+    vid = BaseVideo({"name": Path("gallery", name)}, OPTIONS)
+    vid.reencode((1280, 720))
+    vid.reencode((640, None))
+    vid.thumbnail((None, 300))
+    return vid
+
+
+def build_path(output):
+    return str(Path("build") / output.filepath)
+
+
+class TestRenderVideos:
+    @pytest.fixture
+    def videos(self):
+        # Thumbnail of a.mp4 and 1280x720 reencode of b.mp4 are already cached
+        vid1, vid2 = video("a.mp4"), video("b.mp4")
+        cached = {
+            build_path(list(vid1.thumbnails.values())[0]),
+            build_path(list(vid2.reencodes.values())[0]),
+        }
+        with patch.object(
+            recitale.recitale.CACHE,
+            "needs_to_be_generated",
+            side_effect=lambda source, target, options: target not in cached,
+        ), patch.object(recitale.recitale.CACHE, "cache_picture") as cache_picture:
+            yield vid1, vid2, cache_picture
+
+    @patch("recitale.recitale.subprocess.run")
+    def test_command(self, run, videos):
+        vid1, vid2, cache_picture = videos
+        run.return_value.returncode = 0
+        recitale.recitale.render_videos([vid1, vid2])
+
+        big, small = [build_path(r) for r in vid1.reencodes.values()]
+        small2 = build_path(list(vid2.reencodes.values())[1])
+        thumbnail = build_path(list(vid2.thumbnails.values())[0])
+        run.assert_called_once_with(
+            # fmt: off
+            [
+                "ffmpeg", "-loglevel", "error", "-y", "-stats",
+                "-i", "gallery/a.mp4",
+                "-i", "gallery/b.mp4",
+                "-map", "0:v:0", "-map", "0:a:0?",
+                "-c:v", "libvpx", "-b:v", "3900k", "-qmin", "10", "-qmax", "42",
+                "-c:a", "libvorbis", "-b:a", "100k", "-f", "webm", "-s", "1280x720",
+                big,
+                "-map", "0:v:0", "-map", "0:a:0?",
+                "-c:v", "libvpx", "-b:v", "3900k", "-qmin", "10", "-qmax", "42",
+                "-c:a", "libvorbis", "-b:a", "100k", "-f", "webm", "-s", "640x-1",
+                small,
+                "-map", "1:v:0", "-map", "1:a:0?",
+                "-c:v", "libvpx", "-b:v", "3900k", "-qmin", "10", "-qmax", "42",
+                "-c:a", "libvorbis", "-b:a", "100k", "-f", "webm", "-s", "640x-1",
+                small2,
+                "-map", "1:v:0", "-frames:v", "1", "-vf", "scale=-1:300",
+                thumbnail,
+            ]
+            # fmt: on
+        )
+        assert cache_picture.call_args_list == [
+            call(vid1.filepath, big, vid1.options),
+            call(vid1.filepath, small, vid1.options),
+            call(vid2.filepath, small2, vid2.options),
+            call(vid2.filepath, thumbnail, vid2.options),
+        ]
+
+    @patch("recitale.recitale.subprocess.run")
+    def test_cached(self, run):
+        with patch.object(
+            recitale.recitale.CACHE, "needs_to_be_generated", return_value=False
+        ), patch.object(recitale.recitale.CACHE, "cache_picture") as cache_picture:
+            recitale.recitale.render_videos([video("a.mp4"), video("b.mp4")])
+
+        run.assert_not_called()
+        cache_picture.assert_not_called()
+
+    @patch("recitale.recitale.subprocess.run")
+    def test_failed_batch(self, run, videos):
+        vid1, vid2, cache_picture = videos
+        # The batched run fails because of b.mp4, a.mp4 alone succeeds
+        run.side_effect = lambda command: subprocess.CompletedProcess(
+            command, int("gallery/b.mp4" in command)
+        )
+        recitale.recitale.render_videos([vid1, vid2])
+
+        assert run.call_count == 3
+        assert cache_picture.call_args_list == [
+            call(vid1.filepath, build_path(reencode), vid1.options)
+            for reencode in vid1.reencodes.values()
+        ]
+
+    # ffmpeg exits with 255 when interrupted with Ctrl+C, negative codes are signals
+    @pytest.mark.parametrize("returncode", [255, -2])
+    @patch("recitale.recitale.subprocess.run")
+    def test_interrupted_batch(self, run, videos, returncode):
+        vid1, vid2, cache_picture = videos
+        run.return_value.returncode = returncode
+        recitale.recitale.render_videos([vid1, vid2])
+
+        run.assert_called_once()
+        cache_picture.assert_not_called()
+
+    @patch("recitale.recitale.subprocess.run")
+    def test_interrupted_build(self, run, videos):
+        vid1, vid2, cache_picture = videos
+        run.return_value.returncode = 1
+        with patch.object(recitale.recitale, "INTERRUPTED") as interrupted:
+            # Failed while the build is being stopped
+            interrupted.is_set.side_effect = [False, True]
+            recitale.recitale.render_videos([vid1, vid2])
+            run.assert_called_once()
+
+            # Started after the build was stopped
+            interrupted.is_set.side_effect = None
+            interrupted.is_set.return_value = True
+            recitale.recitale.render_videos([vid1, vid2])
+            run.assert_called_once()
+
+        cache_picture.assert_not_called()
+
+
+@pytest.fixture
+def interrupted():
+    yield recitale.recitale.INTERRUPTED
+    recitale.recitale.INTERRUPTED.clear()
+
+
+@pytest.fixture
+def futures():
+    # Futures submitted to thread pools, in order
+    futures = []
+    executor_submit = ThreadPoolExecutor.submit
+
+    def submit(executor, *args):
+        futures.append(executor_submit(executor, *args))
+        return futures[-1]
+
+    with patch.object(ThreadPoolExecutor, "submit", autospec=True, side_effect=submit):
+        yield futures
+
+
+def test_interrupted_thumbnails(futures):
+    images = [BaseImage({"name": Path("g", name)}, {}) for name in "abc"]
+
+    def noncached_images(base):
+        if base is images[0]:
+            raise KeyboardInterrupt
+        # Still running when the interruption is handled
+        for _ in range(500):
+            if futures[-1].cancelled():
+                break
+            time.sleep(0.01)
+
+    with patch.object(
+        recitale.recitale.ImageFactory,
+        "base_imgs",
+        {image.filepath: image for image in images},
+    ), patch.object(recitale.recitale.CACHE, "getsize", return_value=0), patch(
+        "recitale.recitale.noncached_images", side_effect=noncached_images
+    ) as noncached, patch(
+        "recitale.recitale.render_thumbnails"
+    ) as render, pytest.raises(
+        KeyboardInterrupt
+    ):
+        # A single worker
+        recitale.recitale.generate_thumbnails(1)
+
+    # The worker may have started checking the second image before the interruption was
+    # handled, but nothing after it
+    assert noncached.call_count == 2 - futures[1].cancelled()
+    assert futures[2].cancelled()
+    render.assert_not_called()
+
+
+@patch("recitale.recitale.subprocess.run")
+def test_interrupted_reencodes(run, interrupted, futures):
+    # Three batches of videos, from different directories, and an audio file
+    videos = [BaseVideo({"name": Path(d, "a.mp4")}, OPTIONS) for d in "abc"]
+    audio = BaseAudio(Path("d", "a.mp3"), {"extension": "mp3"})
+
+    def render_videos(batch):
+        if batch[0] is videos[0]:
+            raise KeyboardInterrupt
+        # Like ffmpeg, runs until interrupted
+        interrupted.wait(5)
+
+    with patch.object(
+        recitale.recitale.VideoFactory,
+        "base_vids",
+        {video.filepath: video for video in videos},
+    ), patch.object(
+        recitale.recitale.AudioFactory, "base_audios", {audio.filepath: audio}
+    ), patch(
+        "recitale.recitale.render_videos", side_effect=render_videos
+    ) as render, pytest.raises(
+        KeyboardInterrupt
+    ):
+        # A single worker
+        recitale.recitale.generate_reencodes(2)
+
+    assert interrupted.is_set()
+    # The worker may have started the second batch before the interruption was handled, but
+    # nothing after it
+    assert render.call_count == 2 - futures[1].cancelled()
+    assert futures[2].cancelled()
+    assert futures[3].cancelled()
+    run.assert_not_called()
+
+
+@pytest.mark.parametrize(
+    "orientation,sizes,expected",
+    [
+        # Twice the size of the biggest thumbnail
+        (1, [(None, 300)], (800, 600)),
+        (1, [(400, None)], (800, 600)),
+        (1, [(None, 300), (None, 600)], (1600, 1200)),
+        # Thumbnail sizes apply to the image once transposed
+        (6, [(None, 300)], (600, 450)),
+        (6, [(400, None)], (1067, 800)),
+        # Images aren't resized when both dimensions are specified
+        (1, [(400, 300)], None),
+        (1, [(None, 300), (400, 300)], None),
+        # Not worth it when reducing less than twice
+        (1, [(None, 2000)], None),
+    ],
+)
+def test_draft_size(orientation, sizes, expected):
+    img = Image.new("RGB", (4000, 3000))
+    assert recitale.recitale.draft_size(img, sizes, orientation) == expected
+
+
+@pytest.mark.parametrize("xdg_cache_home", [None, ""])
+def test_bytecode_cache_default_dir(tmp_path, monkeypatch, xdg_cache_home):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    if xdg_cache_home is None:
+        monkeypatch.delenv("XDG_CACHE_HOME", raising=False)
+    else:
+        monkeypatch.setenv("XDG_CACHE_HOME", xdg_cache_home)
+
+    cache = recitale.recitale.get_bytecode_cache()
+
+    assert cache.directory == str(tmp_path / "home" / ".cache" / "recitale" / "jinja")
+    assert not (tmp_path / "recitale").exists()
+
+
+class TestDeploy:
+    @pytest.fixture
+    def site(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr("sys.argv", ["recitale", "deploy"])
+        os.makedirs("gallery")
+        Path("gallery/settings.yaml").touch()
+        os.makedirs("build")
+        with patch("recitale.recitale.shutil.which", return_value="/usr/bin/rsync"):
+            yield
+
+    def deploy(self, **deploy):
+        settings = {"include": [], "settings": {"deploy": deploy}}
+        with patch("recitale.recitale.get_settings", return_value=settings), patch(
+            "recitale.recitale.subprocess.run"
+        ) as run:
+            run.return_value.returncode = 0
+            recitale.recitale.main()
+        return run
+
+    @pytest.mark.usefixtures("site")
+    def test_command(self):
+        os.makedirs("build/my gallery")
+        Path("build/index.html").touch()
+        run = self.deploy(
+            dest="/var/www/my site",
+            others='--exclude "*.tmp" --rsh="ssh -p 2222"',
+            ssh=True,
+            username="me",
+            hostname="example.org",
+        )
+        run.assert_called_once_with(
+            # fmt: off
+            [
+                "rsync", "-avz", "--progress", "--exclude", "*.tmp", "--rsh=ssh -p 2222",
+                "build/index.html", "build/my gallery",
+                "me@example.org:/var/www/my site",
+            ]
+            # fmt: on
+        )
+
+    @pytest.mark.usefixtures("site")
+    def test_no_options(self):
+        Path("build/index.html").touch()
+        run = self.deploy(dest="/var/www", others=None, ssh=False)
+        run.assert_called_once_with(
+            ["rsync", "-avz", "--progress", "build/index.html", "/var/www"]
+        )
+
+    @pytest.mark.usefixtures("site")
+    def test_empty_build(self):
+        with pytest.raises(SystemExit) as sysexit:
+            self.deploy(dest="/var/www", others=None, ssh=False)
+        assert sysexit.value.code == 1
+
+
+class TestParallelBuild:
+    @pytest.fixture(autouse=True)
+    def site(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        Path("settings.yaml").write_text("title: Site\n")
+        os.makedirs("shared")
+        Image.new("RGB", (800, 600), "blue").save("shared/a.jpg")
+        Path("shared/a.mp4").touch()
+        # All galleries share the same media
+        for i in range(8):
+            os.makedirs("gallery%d" % i)
+            Path("gallery%d" % i, "settings.yaml").write_text(
+                "title: gallery%d\n"
+                "date: 2020-01-0%d\n"
+                "cover: ../shared/a.jpg\n"
+                "sections:\n"
+                "  - type: pictures-group\n"
+                "    images:\n"
+                "      -\n"
+                "        - ../shared/a.jpg\n"
+                "        - name: ../shared/a.mp4\n"
+                "          type: video\n" % (i, i + 1)
+            )
+        yield
+        ImageFactory.base_imgs = dict()
+        VideoFactory.base_vids = dict()
+
+    def build(self, jobs, monkeypatch):
+        ImageFactory.base_imgs = dict()
+        VideoFactory.base_vids = dict()
+        monkeypatch.setattr("sys.argv", ["recitale", "build", "--jobs", str(jobs)])
+        with patch(
+            "recitale.recitale.shutil.which", return_value="/usr/bin/ffmpeg"
+        ), patch(
+            "recitale.recitale.build_index", wraps=recitale.recitale.build_index
+        ) as build_index, patch.object(
+            recitale.recitale.CACHE, "prewarm"
+        ) as prewarm, patch.object(
+            recitale.recitale.CACHE, "cache_dump"
+        ), patch(
+            "recitale.recitale.generate_thumbnails"
+        ), patch(
+            "recitale.recitale.generate_reencodes"
+        ):
+            recitale.recitale.main()
+
+        assert len(ImageFactory.base_imgs) == 1
+        assert len(VideoFactory.base_vids) == 1
+        # Covers given to the front page index, and thumbnails and reencodes to render
+        return build_index.call_args.args[1], prewarm.call_args.args[0]
+
+    def test_build(self, monkeypatch):
+        covers, outputs = self.build(4, monkeypatch)
+
+        # Covers are in the same order as the galleries directories, whichever is built first
+        galleries = [
+            x for x in os.listdir() if os.path.exists(Path(x, "settings.yaml"))
+        ]
+        assert [cover["title"] for cover in covers] == galleries
+        for gallery in galleries:
+            assert Path("build", gallery, "index.html").exists()
+
+        # Thumbnails and reencodes shared by galleries are registered once, as when galleries
+        # are built one after the other
+        assert len(outputs) == len(set(outputs))
+        sequential_covers, sequential_outputs = self.build(1, monkeypatch)
+        assert sequential_covers == covers
+        assert sorted(sequential_outputs) == sorted(outputs)
+
+
+class TestReplaceFile:
+    def test_hardlinked_destination(self, tmp_path):
+        # build/static is made of hardlinks to static/
+        (tmp_path / "static").mkdir()
+        (tmp_path / "build").mkdir()
+        (tmp_path / "static" / "custom.css").write_text("static")
+        os.link(tmp_path / "static" / "custom.css", tmp_path / "build" / "custom.css")
+        (tmp_path / "custom.css").write_text("custom")
+
+        recitale.recitale.replace_file(tmp_path / "custom.css", tmp_path / "build")
+
+        assert (tmp_path / "build" / "custom.css").read_text() == "custom"
+        assert (tmp_path / "static" / "custom.css").read_text() == "static"
+
+    def test_destination_hardlinked_to_source(self, tmp_path):
+        # e.g. include: [static/css/fonts.css]
+        (tmp_path / "build").mkdir()
+        (tmp_path / "fonts.css").write_text("fonts")
+        os.link(tmp_path / "fonts.css", tmp_path / "build" / "fonts.css")
+
+        recitale.recitale.replace_file(tmp_path / "fonts.css", tmp_path / "build")
+
+        assert (tmp_path / "build" / "fonts.css").read_text() == "fonts"
+        assert not (tmp_path / "build" / "fonts.css").samefile(tmp_path / "fonts.css")
+
+
+def rotated_jpeg(path):
+    # 800x600 picture whose upright version is 600x800, with a red top-left corner before rotation
+    img = Image.new("RGB", (800, 600), "blue")
+    img.paste("red", (0, 0, 100, 100))
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    img.save(path, quality=90, subsampling=0, exif=exif)
+
+
+def render(filepath, sizes, **options):
+    base = BaseImage(
+        {"name": Path(filepath)},
+        dict(quality=75, progressive=True, **options),
+    )
+    for size in sizes:
+        base.thumbnail(size)
+    with patch.object(
+        recitale.recitale.CACHE, "needs_to_be_generated", return_value=True
+    ), patch.object(recitale.recitale.CACHE, "cache_picture"):
+        recitale.recitale.render_thumbnails(base)
+    outputs = {}
+    for size, thumbnail in zip(sizes, base.thumbnails.values()):
+        outputs[size] = Image.open(Path("build") / thumbnail.filepath)
+        outputs[size].load()
+    return outputs
+
+
+def red_corner(img):
+    # Whether the red corner of rotated_jpeg() is where it should be, with or without rotation
+    red, green, blue = img.convert("RGB").getpixel(
+        (img.width - 1, 0) if img.width < img.height else (0, 0)
+    )
+    return red > 200 and blue < 50
+
+
+@pytest.mark.parametrize("auto_orient", [True, False])
+@pytest.mark.parametrize("strip", [True, False])
+def test_vips_thumbnails(tmp_path, monkeypatch, strip, auto_orient):
+    if recitale.recitale.pyvips is None:
+        pytest.skip("pyvips is not available")
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("build/g")
+    os.makedirs("g")
+    rotated_jpeg("g/a.jpg")
+
+    # Same thumbnails with libvips as with Pillow
+    sizes = [(None, 400), (600, 800)]
+    options = {"strip": strip, "auto-orient": auto_orient}
+    with patch("recitale.recitale.pyvips", None):
+        pillow = render("g/a.jpg", sizes, **options)
+    with patch(
+        "recitale.recitale.vips_thumbnail", wraps=recitale.recitale.vips_thumbnail
+    ) as vips:
+        libvips = render("g/a.jpg", sizes, **options)
+    assert vips.call_count == 2
+
+    for outputs in pillow, libvips:
+        if auto_orient:
+            assert outputs[(None, 400)].size == (300, 400)
+            # Thumbnails with both dimensions specified are saved as-is
+            assert outputs[(600, 800)].size == (600, 800)
+        else:
+            assert outputs[(None, 400)].size == (533, 400)
+            assert outputs[(600, 800)].size == (800, 600)
+        for img in outputs.values():
+            assert red_corner(img)
+            # Orientation is either applied to the pixels or left to the viewers
+            if not strip:
+                assert img.getexif().get(0x0112, 1) == (1 if auto_orient else 6)
+            else:
+                assert "exif" not in img.info
+            assert JpegImagePlugin.get_sampling(img) == 0
+        # Progressive only from 512x512 pixels
+        assert not outputs[(None, 400)].info.get("progressive")
+        assert outputs[(600, 800)].info.get("progressive")
+
+    for size in sizes:
+        assert libvips[size].quantization == pillow[size].quantization
+
+
+@patch("recitale.recitale.pyvips", None)
+def test_pillow_thumbnails(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("build/g")
+    os.makedirs("g")
+    rotated_jpeg("g/a.jpg")
+    img = Image.new("RGB", (800, 600), "blue")
+    img.paste("red", (0, 0, 100, 100))
+    img.save("g/b.png")
+
+    # JPEG files are re-opened and decoded at reduced size only for the thumbnails that can
+    # benefit from it, the others are copied from the image decoded once
+    with patch.object(
+        JpegImagePlugin.JpegImageFile,
+        "draft",
+        autospec=True,
+        side_effect=JpegImagePlugin.JpegImageFile.draft,
+    ) as draft, patch.object(Image, "open", wraps=Image.open) as image_open:
+        jpeg = render("g/a.jpg", [(None, 200), (600, 800)], **{"auto-orient": True})
+    assert [str(c.args[0]) for c in image_open.call_args_list].count("g/a.jpg") == 2
+    draft.assert_called_once()
+    assert draft.call_args.args[2] == (400, 300)
+    assert jpeg[(None, 200)].size == (150, 200)
+    assert jpeg[(600, 800)].size == (600, 800)
+    for img in jpeg.values():
+        assert red_corner(img)
+        # Thumbnails are upright, viewers must not rotate them once more
+        assert img.getexif().get(0x0112, 1) == 1
+    # Progressive only from 512x512 pixels
+    assert not jpeg[(None, 200)].info.get("progressive")
+    assert jpeg[(600, 800)].info.get("progressive")
+
+    # Unrotated JPEG files are drafted by Image.thumbnail() itself
+    Image.open("g/a.jpg").save("g/c.jpg")
+    with patch.object(
+        JpegImagePlugin.JpegImageFile,
+        "draft",
+        autospec=True,
+        side_effect=JpegImagePlugin.JpegImageFile.draft,
+    ) as draft:
+        jpeg = render("g/c.jpg", [(None, 150)])
+    draft.assert_called_once()
+    assert draft.call_args.args[1] is None
+    assert jpeg[(None, 150)].size == (200, 150)
+
+    png = render("g/b.png", [(None, 300), (800, 600)])
+    assert png[(None, 300)].size == (400, 300)
+    assert png[(800, 600)].size == (800, 600)
+    for img in png.values():
+        assert red_corner(img)
@@ -1,3 +1,7 @@
+import base64
+import os
+from datetime import date
+from pathlib import Path
 import pytest
 from unittest.mock import mock_open, patch
 
@@ -21,6 +25,65 @@ def test_remove_superficial_options():
     assert cleaned == to_keep
 
 
+def test_rfc822():
+    assert recitale.utils.rfc822(date(2020, 11, 4)) == "Wed, 04 Nov 2020 00:00:00 -0000"
+
+
+def test_source_path(tmp_path, monkeypatch):
+    (tmp_path / "site").mkdir()
+    gallery = str(tmp_path / "site" / "gallery")
+    monkeypatch.chdir(tmp_path)
+    assert recitale.utils.source_path(gallery, "../a.jpg") == Path("site/a.jpg")
+    # Same arguments, from another directory
+    monkeypatch.chdir(tmp_path / "site")
+    assert recitale.utils.source_path(gallery, "../a.jpg") == Path("a.jpg")
+
+
+def test_evp_bytes_to_key():
+    # Output of `openssl enc -aes-256-cbc -md md5 -pass pass:secret -S 0001020304050607 -P`
+    derived = recitale.utils.evp_bytes_to_key(b"secret", bytes(range(8)), 48)
+    assert derived.hex().upper() == (
+        "035FB8145B73CF111570DC936112BE9C375A5D3D8B915BC213BDBEF9DBFB7851"
+        "1D112C3C48B1D30DBCEEAFF080816BE4"
+    )
+
+
+def test_aes_encrypt():
+    pytest.importorskip("cryptography")
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+    encrypted = base64.b64decode(recitale.utils.aes_encrypt("secret", b"<html></html>"))
+    assert encrypted[:8] == b"Salted__"
+    derived = recitale.utils.evp_bytes_to_key(b"secret", encrypted[8:16], 48)
+    decryptor = Cipher(
+        algorithms.AES(derived[:32]), modes.CBC(derived[32:])
+    ).decryptor()
+    decrypted = decryptor.update(encrypted[16:]) + decryptor.finalize()
+    # PKCS7 padding
+    assert decrypted == b"<html></html>" + bytes([3] * 3)
+
+
+class TestWriteIfChanged:
+    def test_new_file(self, tmp_path):
+        path = tmp_path / "index.html"
+        assert recitale.utils.write_if_changed(path, b"content") is True
+        assert path.read_bytes() == b"content"
+
+    def test_changed_file(self, tmp_path):
+        path = tmp_path / "index.html"
+        path.write_bytes(b"old content")
+        assert recitale.utils.write_if_changed(path, b"content") is True
+        assert path.read_bytes() == b"content"
+        assert [p.name for p in tmp_path.iterdir()] == ["index.html"]
+
+    def test_unchanged_file(self, tmp_path):
+        path = tmp_path / "index.html"
+        path.write_bytes(b"content")
+        os.utime(path, (0, 0))
+        assert recitale.utils.write_if_changed(path, b"content") is False
+        assert path.stat().st_mtime == 0
+
+
 class TestLoadSettings:
     def test_no_settings_yaml(self):
         with pytest.raises(SystemExit) as sysexit:
@@ -47,35 +110,39 @@ class TestLoadSettings:
         assert sysexit.type == SystemExit
         assert sysexit.value.code == 1
 
-    @patch("recitale.utils.yaml.safe_load", return_value=[])
+    @patch("recitale.utils.yaml.YAML")
     def test_not_dict_settings_yaml(self, mock_yaml):
+        mock_yaml.return_value.load.return_value = []
         with pytest.raises(SystemExit) as sysexit, patch("builtins.open", mock_open()):
             recitale.utils.load_settings(".")
 
         assert sysexit.type == SystemExit
         assert sysexit.value.code == 1
 
-    @patch("recitale.utils.yaml.safe_load", return_value={})
+    @patch("recitale.utils.yaml.YAML")
     def test_missing_title(self, mock_yaml):
+        mock_yaml.return_value.load.return_value = {}
         with pytest.raises(SystemExit) as sysexit, patch("builtins.open", mock_open()):
             recitale.utils.load_settings(".")
 
         assert sysexit.type == SystemExit
         assert sysexit.value.code == 1
 
-    @patch(
-        "recitale.utils.yaml.safe_load",
-        return_value={"title": "test", "date": "01-01-1970"},
-    )
+    @patch("recitale.utils.yaml.YAML")
     def test_bad_date_format(self, mock_yaml):
+        mock_yaml.return_value.load.return_value = {
+            "title": "test",
+            "date": "01-01-1970",
+        }
         with pytest.raises(SystemExit) as sysexit, patch("builtins.open", mock_open()):
             recitale.utils.load_settings(".")
 
         assert sysexit.type == SystemExit
         assert sysexit.value.code == 1
 
-    @patch("recitale.utils.yaml.safe_load", return_value={"title": "test"})
+    @patch("recitale.utils.yaml.YAML")
     def test_valid_settings(self, mock_yaml):
+        mock_yaml.return_value.load.return_value = {"title": "test"}
         with patch("builtins.open", mock_open()):
             settings = recitale.utils.load_settings(".")
 
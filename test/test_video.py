@@ -57,3 +57,14 @@ class TestVideoFactory:
         base_vids = VideoFactory.base_vids
         assert len(base_vids.keys()) == 1
         assert vid1 == list(base_vids.values())[0]
+
+    def test_parallel_galleries(self, parallel_galleries):
+        def gallery(i):
+            video = {"name": "../shared/test.mp4", "type": "video", "extension": "webm"}
+            vid = VideoFactory.get("gallery%d" % i, video)
+            return vid, vid.reencode((1280, 720)), vid.thumbnail((None, 720))
+
+        vid, reencode, thumbnail = parallel_galleries(gallery)
+        assert list(VideoFactory.base_vids.values()) == [vid]
+        assert len(vid.reencodes) == 1
+        assert len(vid.thumbnails) == 1